@@ -29,7 +29,6 @@ Example usage from the Python interpreter::
   >>> rain.rain((200, 9))
 """
 from __future__ import division
-import copy
 import sys
 import numpy as np
 import matplotlib.pyplot as plt
@@ -37,6 +36,9 @@ import matplotlib.colors as colors
 import matplotlib.cm as cmx
 import matplotlib.colorbar as colorbar
 import os,glob
+from kernels import (upstream_step, fcts_step, nsdf_step,
+                     lax_wendroff_step, cn_rhs_kernel, thomas_factor,
+                     thomas_substitute, make_upstream_run)
 
 class Quantity(object):
     """Generic quantity to define the data structures and method that
@@ -44,52 +46,54 @@ class Quantity(object):
 
     u and h objects will be instances of this class.
     """
-    def __init__(self, n_grid, n_time):
-        """Initialize an object with prev, now, and next arrays of
-        n_grid points, and a store array of n_time time steps.
+    def __init__(self, n_grid, n_time, store_every=1):
+        """Initialize an object with now and next arrays of
+        n_grid points, and a store array for every store_every-th one
+        of n_time time steps.
         """
         self.n_grid = n_grid
-        # Storage for values at previous, current, and next time step
-        self.prev = np.empty(n_grid)
-        self.now = np.empty(n_grid)
-        self.next = np.empty(n_grid)
+        # Storage for values at current and next time step
+        self.now = np.empty(n_grid, dtype=np.float64)
+        self.next = np.empty(n_grid, dtype=np.float64)
         # Storage for results at each time step.  In a bigger model
         # the time step results would be written to disk and read back
         # later for post-processing (such as plotting).
-        self.store = np.empty((n_grid, n_time))
+        # One row per stored time step, so each stored step is a
+        # contiguous block of memory.
+        self.store_every = store_every
+        self.store = np.empty((-(-n_time // store_every), n_grid))
 
     def store_timestep(self, time_step, attr='next'):
         """Copy the values for the specified time step to the storage
-        array.
+        array.  time_step is the row of the storage array, i.e. the
+        model time step divided by store_every.
 
-        The `attr` argument is the name of the attribute array (prev,
-        now, or next) that we are going to store.  Assigning the value
+        The `attr` argument is the name of the attribute array (now or
+        next) that we are going to store.  Assigning the value
         'next' to it in the function def statement makes that the
         default, chosen because that is the most common use (in the
         time step loop).
         """
-        # The __getattribute__ method let us access the attribute
-        # using its name in string form;
-        # i.e. x.__getattribute__('foo') is the same as x.foo, but the
-        # former lets us change the name of the attribute to operate
-        # on at runtime.
-        self.store[:, time_step] = self.__getattribute__(attr)
+        # The getattr function lets us access the attribute using its
+        # name in string form;
+        # i.e. getattr(x, 'foo') is the same as x.foo, but the former
+        # lets us change the name of the attribute to operate on at
+        # runtime.
+        self.store[time_step, :] = getattr(self, attr)
 
 
     def shift(self):
-        """Copy the .now values to .prev, and the .next values to .new.
+        """Move the .next values to .now.
 
-        This reduces the storage requirements of the model to 3 n_grid
+        This reduces the storage requirements of the model to 2 n_grid
         long arrays for each quantity, which becomes important as the
-        domain size and model complexity increase.  It is possible to
-        reduce the storage required to 2 arrays per quantity.
+        domain size and model complexity increase.
         """
-        # Note the use of the copy() method from the copy module in
-        # the standard library here to get a copy of the array, not a
-        # copy of the reference to it.  This is an important and
-        # subtle aspect of the Python data model.
-        self.prev = copy.copy(self.now)
-        self.now = copy.copy(self.next)
+        # Swap the references rather than copying the arrays: the old
+        # .now array is reused for .next, and the scheme writes the new
+        # values into it on the following time step.  Nothing else
+        # holds on to these arrays, so no copy is needed.
+        self.now, self.next = self.next, self.now
 
 
 def initial_conditions(c1,c, n_grid):
@@ -106,69 +110,53 @@ def boundary_conditions(c_array, n_grid):
     c_array[n_grid-1] = c_array[n_grid-2]
 
 
-def first_time_step(c,c1, n_grid):
-    """Calculate the first time step values from the analytical
-    predictor-corrector derived from equations 4.18 and 4.19.
-    """
-    ##maybe if we actually use leapfrog
-
-
 def scheme(c, u, k, n_grid, dt, dx):
     """Calculate the next time step values using the leap-frog scheme
     derived from equations 4.16 and 4.17.
     """
-    for pt in np.arange(1, n_grid - 1):
+    upstream_step(c.now, c.next, u*dt/dx, k*dt/dx**2, n_grid)
 
-        c.next[pt] = c.now[pt] - u*(dt/dx)*(c.now[pt] - c.now[pt-1])  + k* (dt/(dx**2))*(c.now[pt + 1] - 2*c.now[pt] + c.now[pt - 1]) 
+def cn_setup(u, k, n_grid, dt, dx):
+    """Build and factor the Crank-Nicolson system.
 
-#     Alternate vectorized implementation:
-#     u.next[1:n_grid - 1] = (u.prev[1:n_grid - 1]
-#                             - gu * (h.now[2:n_grid] - h.now[:n_grid - 2]))
-#     h.next[1:n_grid - 1] = (h.prev[1:n_grid - 1]
-#                             - gh * (u.now[2:n_grid] - u.now[:n_grid - 2]))
-
-def Crank_Nicolson(c, u, k, n_grid, dt, dx):
-    
+    The matrices only depend on the model parameters, so call this once
+    before the time step loop and pass the result to cn_step().
+    """
     a = (u*dt)/(4*dx)
     b = (k*dt)/(2*(dx**2))
     
     cof1 = [-a-b, 1+2*b, a-b]
     cof2 = [a+b, 1-2*b, b-a]
     
-
-    cof1_all = np.zeros((n_grid,n_grid))
-    cof2_all = np.zeros((n_grid,n_grid))
-    init = np.zeros(n_grid)
-    cof2_all[0,:] = init
-    init[0] = 1
-    init[1] = -1
-    cof1_all[0,:] = init
-    for pt in np.arange(1, n_grid - 1):
-        c_cur = np.zeros(n_grid)
-        c_cur[pt-1] = -a-b
-        c_cur[pt] = 1+2*b
-        c_cur[pt+1] = a-b
-        cof1_all[pt,:]=c_cur
-        c_cur1 = np.zeros(n_grid)
-        c_cur1[pt-1] = a+b
-        c_cur1[pt] = 1-2*b
-        c_cur1[pt+1] = b-a
-        cof2_all[pt,:] = c_cur1
-    lstit = np.zeros(n_grid)
-    cof2_all[-1,:]= lstit
-    lstit[-1] = 1
-    lstit[-2] = -1
-    cof1_all[-1,:] = lstit
-    c_mid = c.now.copy()
-    rhs = np.matmul(cof2_all,np.transpose(c_mid))
-    nxt = np.matmul(np.linalg.inv(cof1_all),rhs)
-    for pt in np.arange(1, n_grid - 1):
-        c.next[pt] = max(0,nxt[pt])
+    # The system is tridiagonal, so store only the three diagonals of
+    # the implicit matrix.  The first and last rows carry the
+    # zero-gradient boundary conditions.
+    lower = np.full(n_grid, cof1[0])
+    diag = np.full(n_grid, cof1[1])
+    upper = np.full(n_grid, cof1[2])
+    lower[0], diag[0], upper[0] = 0, 1, -1
+    lower[-1], diag[-1], upper[-1] = -1, 1, 0
+    w, piv = thomas_factor(lower, diag, upper)
+    # Right hand side array, reused by every cn_step() call, which
+    # also solves for the next time step in place in it.
+    rhs = np.zeros(n_grid)
+    return w, piv, upper, cof2, rhs
+
+
+def cn_step(cn, c, n_grid):
+    """Calculate the next time step values with the Crank-Nicolson
+    system cn returned by cn_setup().
+    """
+    w, piv, upper, cof2, rhs = cn
+    cn_rhs_kernel(c.now, rhs, cof2[0], cof2[1], cof2[2], n_grid)
+    thomas_substitute(w, piv, upper, rhs)
+    # Clamp negative concentrations to zero
+    np.maximum(rhs[1:-1], 0.0, out=c.next[1:-1])
 
     
 #     while True:
 #         c_old = c.next
-#         for pt in np.arange(1, n_grid - 1):
+#         for pt in range(1, n_grid - 1):
 #             c.next[pt] = c.now[pt] - ((u*dt)/(4*dx))*(c_old[pt+1] - c_old[pt-1] + c.now[pt+1] - c.now[pt-1]) + ((k*dt)/(2*(dx**2)))*(c_old[pt-1] - 2*c_old[pt] + c_old[pt+1] + c.now[pt-1] - 2*c.now[pt] + c.now[pt+1])
         
 #         change = (c.next - c_old)/max(c_old)
@@ -176,22 +164,31 @@ def Crank_Nicolson(c, u, k, n_grid, dt, dx):
 #             break
 
 
-def Upstream(c, u, k, n_grid, dt, dx):
+def Crank_Nicolson(c, u, k, n_grid, dt, dx):
+    """Calculate one Crank-Nicolson time step, building the system from
+    scratch.  In a time step loop use cn_setup() and cn_step() instead.
+    """
+    cn = cn_setup(u, k, n_grid, dt, dx)
+    cn_step(cn, c, n_grid)
+
+
+def Upstream(c, cfl, d, n_grid):
+    """Calculate the next time step values using the upstream scheme;
+    cfl = u*dt/dx and d = k*dt/dx**2.
+    """
 
-#    for pt in np.arange(1, n_grid - 1):
+#    for pt in range(1, n_grid - 1):
 #        c.next[pt] = c.now[pt] - u*(dt/dx)*(c.now[pt + 1] - c.now[pt])  + k* (dt/(dx**2))*(c.now[pt + 1] - 2*c.now[pt] + c.now[pt - 1]) 
 
-    for pt in np.arange(1, n_grid - 1):
-        c.next[pt] = c.now[pt] - u*(dt/dx)*(c.now[pt] - c.now[pt - 1])  + ((k*dt)/(dx**2))*(c.now[pt + 1] - 2*c.now[pt] + c.now[pt - 1])       
+    upstream_step(c.now, c.next, cfl, d, n_grid)
 
 
 def FCTS(c, u, k, n_grid, dt, dx):
 
-#    for pt in np.arange(1, n_grid - 1):
+#    for pt in range(1, n_grid - 1):
 #        c.next[pt] = c.now[pt] - u*(dt/dx)*(c.now[pt + 1] - c.now[pt])  + k* (dt/(dx**2))*(c.now[pt + 1] - 2*c.now[pt] + c.now[pt - 1]) 
 
-    for pt in np.arange(1, n_grid - 1):
-        c.next[pt] = c.now[pt] - u*(dt/(2*dx))*(c.now[pt+1] - c.now[pt - 1]) # + ((k*dt)/(dx**2))*(c.now[pt + 1] - 2*c.now[pt] + c.now[pt - 1])       
+    fcts_step(c.now, c.next, u*dt/(2*dx), n_grid)
     #print((k*dt)/(dx**2))
 
     
@@ -202,19 +199,17 @@ def nsdf(c,u,K, n_grid,dt,dx):
   a1 = k/h  # coefficient to tidy up equation
   b1 = a1/(np.exp(h/K)-1) # coefficient to tidy up equation
  
-  for pt in np.arange(1, n_grid-1):
-    c.next[pt] = b1*c.now[pt+1]+(1-a1*u-2*b1)*c.now[pt]+(a1*u+b1)*c.now[pt-1]      
+  nsdf_step(c.now, c.next, u, a1, b1, n_grid)
 
 
-def Lax_Wendroff(c, u, k, n_grid, dt, dx):
+def Lax_Wendroff(c, a1, a2, a3, n_grid):
     """Calculate the next time step values using the leap-frog scheme
     derived from equations 4.16 and 4.17.
+
+    a1, a2 and a3 are the coefficients returned by
+    kernels.lax_wendroff_coefficients(u, k, dt, dx).
     """
-    for pt in np.arange(2, n_grid - 2): #note that the grid range is changed
-        c.next[pt] = c.now[pt] - u*(dt/(2*dx))*(c.now[pt + 1] - c.now[pt-1])  + (u**2*dt+2*k) * (dt/(4*dx**2))*(c.now[pt + 1] - 2*c.now[pt] + c.now[pt - 1]) - (k*u*dt**2)/(2*dx**3)*(-c.now[pt-2]+2*c.now[pt-1]-2*c.now[pt+1]+c.now[pt+2])
-#         c.next[pt] = c.now[pt] - u*(dt/(2*dx))*(c.now[pt + 1] - c.now[pt-1])  + (u**2*dt) * (dt/(2*dx^2))*(c.now[pt + 1] - 2*c.now[pt] + c.now[pt - 1]) 
-        if (c.next[pt]<0):
-            c.next[pt]=0
+    lax_wendroff_step(c.now, c.next, a1, a2, a3, n_grid)
 
 def make_graph(cs, dts, n_times):
     """Create graphs of the model results using matplotlib.
@@ -245,15 +240,14 @@ def make_graph(cs, dts, n_times):
         cNorm_inseconds = colors.Normalize(vmin=0, vmax=1.*n_time*dt)
         scalarMap = cmx.ScalarMappable(norm=cNorm, cmap=cmap)
 
-        # Only try to plot 20 lines, so choose an interval if more than that (i.e. plot
-        # every interval lines
-        interval = np.int(np.ceil(n_time/500))
+        # Only the time steps that are plotted are stored (see numeric), so
+        # plot every stored line
 
         # Do the main plot
-        for time in range(0, n_time, interval):
-            colorVal = scalarMap.to_rgba(time)
+        for row in range(len(c.store)):
+            colorVal = scalarMap.to_rgba(row*c.store_every)
 
-            ax_c.plot(c.store[:, time], color=colorVal)
+            ax_c.plot(c.store[row, :], color=colorVal)
 
 
     # Add the custom colorbar
@@ -263,10 +257,52 @@ def make_graph(cs, dts, n_times):
 
     return
 
-def numeric(args):
+def run_one(dt, n_time, n_grid, u, k, c1, dx):
+    """Run the model for one time step dt and return the Quantity
+    holding the stored results.
+    """
+    # make_graph plots at most 500 lines, so only store the time
+    # steps that it will plot
+    store_every = -(-n_time // 500)
+    c = Quantity(n_grid, n_time, store_every)
+
+    # Set up initial conditions and store them in the time step
+    # results arrays
+
+    initial_conditions(c1,c, n_grid)
+    #c.store_timestep(0, 'now')
+
+    # Apply the boundary conditions to the initial values, and store
+    # them in the time step results arrays
+    boundary_conditions(c.now, n_grid)
+
+    c.store_timestep(0, 'now')
+
+
+    # The stencil coefficients are the same for every time step, so
+    # compile them into the time step loop as constants
+    run = make_upstream_run(u*dt/dx, k*dt/(dx*dx), n_grid)
+
+    # Time step loop, run in compiled code: advance the solution, apply
+    # the boundary conditions, store the values in the time step
+    # results array, and swap .next and .now in preparation for the
+    # next time step
+    c.now, c.next = run(c.now, c.next, c.store, c1,
+                        n_grid, n_time, -1, store_every)
+    return c
+
+
+def numeric(args, plot=True, save=None):
     """Run the model.
 
     args is a 2-tuple; (number-of-time-steps, number-of-grid-points)
+
+    Returns the list of Quantity objects holding the runs for each time step.
+    With plot=False the graphs are not drawn; pass the returned list
+    to make_graph to draw them later.  If save is a file name, the
+    stored results are also written to it with np.savez, so they can
+    be read back with load() and plotted without running the model
+    again.
     """
     num_time = int(args[0])
     n_grid = int(args[1])
@@ -279,56 +315,43 @@ def numeric(args):
     c1 = 600.0   #initial pollution amount g/m3
  
     dx = 1000   #stepsize
-    dts = [30,60,180,360]
-    cs = []
-    n_times = []
-    for i in range(len(dts)):
-        dt = dts[i]                # time step [s]
-        # Create velocity and surface height objects
-        if i ==0:
-            n_time = 12*num_time
-        elif i ==1:
-            n_time = 5*num_time
-        elif i==2:
-            n_time = 2*num_time
-        else:
-            n_time = num_time
-        
-        c = Quantity(n_grid, n_time)
-
-        # Set up initial conditions and store them in the time step
-        # results arrays
-
-        initial_conditions(c1,c, n_grid)
-        #c.store_timestep(0, 'now')
-
-        # Calculate the first time step values from the
-        # predictor-corrector, apply the boundary conditions, and store
-        # the values in the time step results arrays
-
-        #first_time_step(u, h, g, H, dt, dx, ho, gu, gh, n_grid)
-        boundary_conditions(c.now, n_grid)
+    dts = [30,60,180,360]     # time steps [s]
+    n_times = [12*num_time, 5*num_time, 2*num_time, num_time]
+    # Each run is a single compiled time step loop that only takes a
+    # few milliseconds, so run them one after another; starting worker
+    # processes would cost more than the runs themselves
+    cs = [run_one(dt, n_time, n_grid, u, k, c1, dx)
+          for dt, n_time in zip(dts, n_times)]
+    if save is not None:
+        np.savez(save, dts=dts, n_times=n_times,
+                 store_every=[c.store_every for c in cs],
+                 **{f'c_{dt}': c.store for dt, c in zip(dts, cs)})
+    # Plot the results as colored graphs
+    if plot:
+        make_graph(cs, dts, n_times)
+    return cs
 
-        c.store_timestep(0, 'now')
 
+def load(filename):
+    """Read back the results that numeric(save=filename) wrote.
 
-        # Time step loop using leap-frog scheme
-        for t in np.arange(1, n_time):
-            # Advance the solution and apply the boundary conditions
-            Upstream(c, u, k, n_grid, dt, dx)
-            boundary_conditions(c.next, n_grid)
-            # Store the values in the time step results arrays, and shift
-            # .now to .prev, and .next to .now in preparation for the next
-            # time step
+    The file holds the time steps dts, the numbers of time steps
+    n_times and the store strides store_every of the runs, and the
+    stored results of the run with time step dt as c_<dt>.
 
-            c.store_timestep(t)
-    #         print('c_curent',c.now)
-            c.shift()
-        cs.append(c)
-        n_times.append(n_time)
-    # Plot the results as colored graphs
-    make_graph(cs, dts, n_times)
-    return
+    Returns (cs, dts, n_times), to pass to make_graph.
+    """
+    with np.load(filename) as data:
+        dts = [int(dt) for dt in data['dts']]
+        n_times = [int(n_time) for n_time in data['n_times']]
+        cs = []
+        for dt, n_time, store_every in zip(dts, n_times,
+                                           data['store_every']):
+            store = data[f'c_{dt}']
+            c = Quantity(store.shape[1], n_time, int(store_every))
+            c.store = store
+            cs.append(c)
+    return cs, dts, n_times
 
 
 if __name__ == '__main__':
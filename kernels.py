@@ -0,0 +1,229 @@
+"""Compiled stencil kernels shared by the advection-diffusion models in
+funcs.py, func_cont.py and funcs_cont2.py.
+
+Each kernel works on the raw .now and .next arrays of a Quantity and
+fills the interior points of .next for one time step; the boundary
+points are left for boundary_conditions() to set.  The kernels take
+the stencil coefficients rather than u, k, dt and dx, so that they are
+worked out once per run instead of once per grid point.
+"""
+import numpy as np
+from numba import njit, prange
+
+
+@njit('void(f8[::1],f8[::1],f8,f8,i8)',
+      cache=True, fastmath=True, boundscheck=False)
+def upstream_kernel(now, nxt, cfl, d, n_grid):
+    """Upstream advection with centred diffusion; cfl = u*dt/dx and
+    d = k*dt/dx**2.
+    """
+    for pt in range(1, n_grid - 1):
+        nxt[pt] = (now[pt] - cfl*(now[pt] - now[pt - 1])
+                   + d*(now[pt + 1] - 2.0*now[pt] + now[pt - 1]))
+
+
+@njit('void(f8[::1],f8[::1],f8,i8)',
+      cache=True, fastmath=True, boundscheck=False)
+def fcts_kernel(now, nxt, a, n_grid):
+    """Forward in time, centred in space advection; a = u*dt/(2*dx)."""
+    for pt in range(1, n_grid - 1):
+        nxt[pt] = now[pt] - a*(now[pt + 1] - now[pt - 1])
+
+
+@njit('void(f8[::1],f8[::1],f8,f8,f8,i8)',
+      cache=True, fastmath=True, boundscheck=False)
+def nsdf_kernel(now, nxt, u, a1, b1, n_grid):
+    """Non-standard finite difference update; a1 and b1 are the tidied
+    coefficients computed in nsdf().
+    """
+    for pt in range(1, n_grid - 1):
+        nxt[pt] = (b1*now[pt + 1] + (1 - a1*u - 2*b1)*now[pt]
+                   + (a1*u + b1)*now[pt - 1])
+
+
+def lax_wendroff_coefficients(u, k, dt, dx):
+    """Return the coefficients a1, a2, a3 of lax_wendroff_kernel()."""
+    a1 = u*dt/(2*dx)
+    a2 = (u**2*dt + 2*k)*dt/(4*dx**2)
+    a3 = k*u*dt**2/(2*dx**3)
+    return a1, a2, a3
+
+
+@njit('void(f8[::1],f8[::1],f8,f8,f8,i8)',
+      cache=True, fastmath=True, boundscheck=False)
+def lax_wendroff_kernel(now, nxt, a1, a2, a3, n_grid):
+    """Lax-Wendroff with the third-derivative correction, clamped to be
+    non-negative.  The range is changed since the correction needs two
+    neighbours on each side.  The coefficients come from
+    lax_wendroff_coefficients().
+    """
+    for pt in range(2, n_grid - 2):
+        val = (now[pt] - a1*(now[pt + 1] - now[pt - 1])
+               + a2*(now[pt + 1] - 2*now[pt] + now[pt - 1])
+               - a3*(-now[pt - 2] + 2*now[pt - 1] - 2*now[pt + 1] + now[pt + 2]))
+        nxt[pt] = max(val, 0.0)
+
+
+# Multi-threaded versions of the stencil kernels.  Every point of .next
+# is written independently, so the loop over the grid is split across
+# threads with prange.  Starting the threads costs more than the sweep
+# itself on small grids, so only use these from PARALLEL_N_GRID points.
+PARALLEL_N_GRID = 10000
+
+
+@njit(parallel=True, cache=True, fastmath=True, boundscheck=False)
+def parallel_upstream_kernel(now, nxt, cfl, d, n_grid):
+    """Multi-threaded upstream_kernel()."""
+    for pt in prange(1, n_grid - 1):
+        nxt[pt] = (now[pt] - cfl*(now[pt] - now[pt - 1])
+                   + d*(now[pt + 1] - 2.0*now[pt] + now[pt - 1]))
+
+
+@njit(parallel=True, cache=True, fastmath=True, boundscheck=False)
+def parallel_fcts_kernel(now, nxt, a, n_grid):
+    """Multi-threaded fcts_kernel()."""
+    for pt in prange(1, n_grid - 1):
+        nxt[pt] = now[pt] - a*(now[pt + 1] - now[pt - 1])
+
+
+@njit(parallel=True, cache=True, fastmath=True, boundscheck=False)
+def parallel_nsdf_kernel(now, nxt, u, a1, b1, n_grid):
+    """Multi-threaded nsdf_kernel()."""
+    for pt in prange(1, n_grid - 1):
+        nxt[pt] = (b1*now[pt + 1] + (1 - a1*u - 2*b1)*now[pt]
+                   + (a1*u + b1)*now[pt - 1])
+
+
+@njit(parallel=True, cache=True, fastmath=True, boundscheck=False)
+def parallel_lax_wendroff_kernel(now, nxt, a1, a2, a3, n_grid):
+    """Multi-threaded lax_wendroff_kernel()."""
+    for pt in prange(2, n_grid - 2):
+        val = (now[pt] - a1*(now[pt + 1] - now[pt - 1])
+               + a2*(now[pt + 1] - 2*now[pt] + now[pt - 1])
+               - a3*(-now[pt - 2] + 2*now[pt - 1] - 2*now[pt + 1] + now[pt + 2]))
+        nxt[pt] = max(val, 0.0)
+
+
+def upstream_step(now, nxt, cfl, d, n_grid):
+    """upstream_kernel(), multi-threaded on large grids."""
+    if n_grid >= PARALLEL_N_GRID:
+        parallel_upstream_kernel(now, nxt, cfl, d, n_grid)
+    else:
+        upstream_kernel(now, nxt, cfl, d, n_grid)
+
+
+def fcts_step(now, nxt, a, n_grid):
+    """fcts_kernel(), multi-threaded on large grids."""
+    if n_grid >= PARALLEL_N_GRID:
+        parallel_fcts_kernel(now, nxt, a, n_grid)
+    else:
+        fcts_kernel(now, nxt, a, n_grid)
+
+
+def nsdf_step(now, nxt, u, a1, b1, n_grid):
+    """nsdf_kernel(), multi-threaded on large grids."""
+    if n_grid >= PARALLEL_N_GRID:
+        parallel_nsdf_kernel(now, nxt, u, a1, b1, n_grid)
+    else:
+        nsdf_kernel(now, nxt, u, a1, b1, n_grid)
+
+
+def lax_wendroff_step(now, nxt, a1, a2, a3, n_grid):
+    """lax_wendroff_kernel(), multi-threaded on large grids."""
+    if n_grid >= PARALLEL_N_GRID:
+        parallel_lax_wendroff_kernel(now, nxt, a1, a2, a3, n_grid)
+    else:
+        lax_wendroff_kernel(now, nxt, a1, a2, a3, n_grid)
+
+
+# Upstream drivers made by make_upstream_run(), keyed by (cfl, d,
+# parallel)
+_upstream_runs = {}
+
+
+def make_upstream_run(cfl, d, n_grid):
+    """Return a driver that runs the whole upstream time step loop in
+    compiled code, with the coefficients cfl and d compiled in as
+    constants.
+
+    The driver is called as run(now, nxt, store, c1, n_grid, n_time,
+    src_idx, store_every).  Each step applies upstream_kernel(), or
+    parallel_upstream_kernel() from PARALLEL_N_GRID points, holds the
+    source point src_idx at c1 (no source if src_idx is negative),
+    applies the zero-gradient boundary conditions, stores every
+    store_every-th step in store, and swaps the buffers as
+    Quantity.shift() does.  It returns the (now, next) arrays after the
+    last step, to be assigned back to the Quantity.
+
+    Each driver is only compiled once per process.  The serial ones are
+    cached on disk like the other kernels; the multi-threaded ones are
+    not, since numba does not always record that a cached function
+    calling a parallel kernel has to start its threads on loading.
+    """
+    parallel = n_grid >= PARALLEL_N_GRID
+    key = (cfl, d, parallel)
+    if key not in _upstream_runs:
+        @njit(cache=not parallel, fastmath=True)
+        def run(now, nxt, store, c1, n_grid, n_time, src_idx, store_every):
+            for t in range(1, n_time):
+                # parallel is a constant, so numba drops the other call
+                if parallel:
+                    parallel_upstream_kernel(now, nxt, cfl, d, n_grid)
+                else:
+                    upstream_kernel(now, nxt, cfl, d, n_grid)
+                if src_idx >= 0:
+                    nxt[src_idx] = c1
+                nxt[0] = nxt[1]
+                nxt[n_grid - 1] = nxt[n_grid - 2]
+                if t % store_every == 0:
+                    store[t // store_every, :] = nxt
+                now, nxt = nxt, now
+            return now, nxt
+        _upstream_runs[key] = run
+    return _upstream_runs[key]
+
+
+@njit('void(f8[::1],f8[::1],f8,f8,f8,i8)',
+      cache=True, fastmath=True, boundscheck=False)
+def cn_rhs_kernel(now, rhs, r0, r1, r2, n_grid):
+    """Explicit half of the Crank-Nicolson step: multiply .now by the
+    tridiagonal matrix with rows (r0, r1, r2).  The boundary rows of
+    the matrix are zero, so the end points of rhs are set to zero.
+    """
+    rhs[0] = 0.0
+    for pt in range(1, n_grid - 1):
+        rhs[pt] = r0*now[pt - 1] + r1*now[pt] + r2*now[pt + 1]
+    rhs[n_grid - 1] = 0.0
+
+
+@njit(cache=True)
+def thomas_factor(lower, diag, upper):
+    """Forward elimination of the tridiagonal matrix with sub-, main and
+    super-diagonals lower, diag and upper.
+
+    Returns the elimination multipliers and the reduced main diagonal,
+    which only depend on the matrix and so can be reused for every
+    right hand side.  lower[0] is not used.
+    """
+    n = diag.shape[0]
+    w = np.zeros(n)
+    piv = diag.copy()
+    for i in range(1, n):
+        w[i] = lower[i]/piv[i - 1]
+        piv[i] -= w[i]*upper[i - 1]
+    return w, piv
+
+
+@njit(cache=True)
+def thomas_substitute(w, piv, upper, x):
+    """Solve for right hand side x using the factors from
+    thomas_factor(), overwriting x with the solution.
+    """
+    n = x.shape[0]
+    # forward elimination of the right hand side
+    for i in range(1, n):
+        x[i] -= w[i]*x[i - 1]
+    # back substitution
+    x[n - 1] = x[n - 1]/piv[n - 1]
+    for i in range(n - 2, -1, -1):
+        x[i] = (x[i] - upper[i]*x[i + 1])/piv[i]